@@ -12,7 +12,9 @@ setup(name='atlas_client',
       url='https://github.com/yerkesobservatory/atlas-client',
       packages=['telescope'],
       install_requires=[
-          'colorlog>=3.0.1',
+          'gevent>=1.3.0',
+          'orjson>=3',
           'websocket-client>=0.44.0',
+          'websockets>=14',
           'six>=1.10.0']
 )
@@ -1,3 +1,13 @@
-from .telescope import Telescope
+from .telescope import Telescope, WeatherSnapshot
 
 Telescope = Telescope
+WeatherSnapshot = WeatherSnapshot
+
+
+def __getattr__(name: str):
+    # the asyncio client loads asyncio and websockets, so only import it when used
+    if name == 'AsyncTelescope':
+        from .async_telescope import AsyncTelescope
+        return AsyncTelescope
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,241 @@
+import asyncio
+import orjson
+from websockets.asyncio.client import connect
+
+from .telescope import (Telescope, WeatherSnapshot, log, _URI_FMT, _ASYNC_TEMPLATE, _init_log,
+                        _server_port, _weather_snapshot, _command_prefix, _build_msg, _parse_reply, _add_commands)
+
+
+class AsyncTelescope(object):
+    """ An asyncio client for the TelescopeServer, so that a single event
+    loop can drive many telescopes at once. It speaks the same protocol
+    and has the same commands as `Telescope`, but every command is a
+    coroutine.
+
+    >>> telescope = await AsyncTelescope.create('user@example.com', 'atlas')
+    >>> cloud, rain = await asyncio.gather(telescope.get_cloud(), telescope.get_rain())
+    """
+
+    __slots__ = ('websocket', 'print_results', '_next_id', '_inflight', '_reader')
+
+    def __init__(self, print_results: bool = False):
+        """ Create a new, unconnected AsyncTelescope; use `create` to
+        create one that is connected to the TelescopeServer.
+        """
+
+        # initialize logging system if not already done
+        if not log.handlers:
+            _init_log()
+
+        # initialize unconnected websocket
+        self.websocket = None
+
+        # commands waiting on a reply, keyed by their request id
+        self._next_id = 0
+        self._inflight = {}
+
+        # task receiving replies from the TelescopeServer
+        self._reader = None
+
+        # whether we should always print raw command results
+        self.print_results = print_results
+
+    @classmethod
+    async def create(cls, username: str, host: str, secure: bool = True,
+                     print_results: bool = False) -> 'AsyncTelescope':
+        """ Create a new AsyncTelescope by connecting to the TelescopeServer
+        and authenticating a new control session.
+        """
+        telescope = cls(print_results)
+        await telescope.connect(username, host, secure)
+
+        return telescope
+
+    async def connect(self, username: str, host: str, secure: bool = True) -> bool:
+        """ Try and connect to the TelescopeServer.
+        """
+        # check the port before asking for a password we couldn't use
+        port = _server_port()
+
+        # don't block the event loop while waiting on the password
+        pw_hash = await asyncio.get_running_loop().run_in_executor(None, Telescope._prompt_and_hash)
+
+        try:
+            # try and connect to telescope server
+            websocket = await connect(_URI_FMT('wss' if secure else 'ws', host, port))
+
+            # send username and password
+            msg = {'action': 'connect',
+                   'email': username,
+                   'password': pw_hash}
+            await websocket.send(orjson.dumps(msg), text=True)
+
+            # wait for connection message
+            reply = orjson.loads(await websocket.recv(decode=False))
+
+            if reply.get('connected'):
+                log.info('Successfully connected to TelescopeServer')
+            else:
+                reason = reply.get('result') or 'unknown'
+                log.warning('Telescope is currently unavailable: %s', reason)
+        except orjson.JSONDecodeError:
+            log.critical('Did not receive valid response from TelescopeServer.')
+            raise Exception('Did not receive valid response from TelescopeServer.')
+        except Exception as e:
+            log.critical('Error occurred in connecting to TelescopeServer: %s', e)
+            raise Exception(f'Unable to connect to TelescopeServer: {e}')
+
+        self.websocket = websocket
+        self._reader = asyncio.ensure_future(self.__reader_loop(websocket))
+
+        return True
+
+    async def is_alive(self) -> bool:
+        """ Check whether connection to telescope server is alive/working
+        by waiting up to a second for it to answer a WebSocket ping.
+        """
+        try:
+            await asyncio.wait_for(await self.websocket.ping(), timeout=1.0)
+            return True
+        except Exception as e:
+            log.warning('%s', e)
+            return False
+
+    async def disconnect(self) -> bool:
+        """ Disconnect the AsyncTelescope from the TelescopeServer.
+        """
+        if self._reader:
+            self._reader.cancel()
+            self._reader = None
+
+        self.__fail_inflight(Exception('Disconnected from TelescopeServer'))
+
+        websocket, self.websocket = self.websocket, None
+        if websocket:
+            await websocket.close()
+
+        return True
+
+    async def get_cloud(self) -> float:
+        """ Get the current cloud coverage.
+        """
+        return await self.run_command('get_cloud')
+
+    async def get_dew(self) -> float:
+        """ Get the current dew value.
+        """
+        return await self.run_command('get_dew')
+
+    async def get_rain(self) -> float:
+        """ Get the current rain value.
+        """
+        return await self.run_command('get_rain')
+
+    async def get_sun_alt(self) -> float:
+        """ Get the current altitude of the sun.
+        """
+        return await self.run_command('get_sun_alt')
+
+    async def get_moon_alt(self) -> float:
+        """ Get the current altitude of the moon.
+        """
+        return await self.run_command('get_moon_alt')
+
+    async def get_weather(self) -> WeatherSnapshot:
+        """ Extract all the values for the current weather
+        and return them as a WeatherSnapshot; `run_command('get_weather')`
+        returns the server's raw dictionary.
+        """
+        return _weather_snapshot(await self.run_command('get_weather'))
+
+    async def offset(self, dra: float, ddec: float) -> bool:
+        """ Offset the pointing of the telescope by a given
+        dRa and dDec
+        """
+        return await self.run_command('offset', ra=dra, dec=ddec)
+
+    async def run_commands(self, commands: list) -> list:
+        """ Run several commands on the telescope server concurrently.
+
+        Parameters
+        ----------
+        commands: list
+            The messages to send, i.e. [{'command': 'goto_target', 'target': 'M31'}]
+
+        Returns
+        -------
+        results: list
+            The result of each command, in the order they were given
+        """
+        return await asyncio.gather(*(self.run_command(**msg) for msg in commands))
+
+    async def run_command(self, command: str, *_, **kwargs):
+        """ Run a command on the telescope server.
+
+        Parameters
+        ----------
+        command: str
+            The command to be run
+        """
+        return await self._send(_command_prefix(command), kwargs)
+
+    async def _send(self, prefix: bytes, kwargs: dict):
+        """ Send the command whose serialized message starts with {prefix}
+        and return its result.
+        """
+
+        # nothing would ever answer a command sent on a dead connection
+        if not self.__connected():
+            raise Exception('Not connected to TelescopeServer')
+
+        # build message, tagged with an id so that we can match its reply
+        self._next_id += 1
+        request_id = self._next_id
+        msg = _build_msg(prefix, request_id, kwargs)
+
+        # register the command before sending so the reply can't be missed
+        result = self._inflight[request_id] = asyncio.get_running_loop().create_future()
+
+        # send message on websocket, forgetting the command if that fails
+        try:
+            await self.websocket.send(msg, text=True)
+        except Exception:
+            self._inflight.pop(request_id, None)
+            raise
+
+        return await result
+
+    def __connected(self) -> bool:
+        """ Check whether we have a connection whose replies are being received.
+        """
+        return bool(self.websocket is not None and self._reader and not self._reader.done())
+
+    def __fail_inflight(self, error: Exception) -> None:
+        """ Raise {error} in every command still waiting on a reply.
+        """
+        inflight, self._inflight = self._inflight, {}
+        for result in inflight.values():
+            if not result.done():
+                result.set_exception(error)
+
+    async def __reader_loop(self, websocket) -> None:
+        """ Receive replies from the TelescopeServer and pass each
+        one to the command that is waiting on it.
+        """
+        try:
+            while True:
+                reply = orjson.loads(await websocket.recv(decode=False))
+
+                # a batch is answered with a list of replies
+                for r in (reply if isinstance(reply, list) else [reply]):
+                    result = self._inflight.pop(r.get('id'), None)
+                    if result and not result.done():
+                        result.set_result(_parse_reply(r, self.print_results))
+                    elif not result:
+                        log.warning('Received unexpected reply from TelescopeServer: %s', r)
+        except Exception as e:
+            log.warning('Lost connection to TelescopeServer: %s', e)
+            self.__fail_inflight(Exception(f'Lost connection to TelescopeServer: {e}'))
+
+
+_add_commands(AsyncTelescope, _ASYNC_TEMPLATE)
@@ -1,29 +1,302 @@
 import os
-import json
+import ssl
 import time
+import atexit
+import orjson
 import hashlib
+import itertools
 import logging
-import colorlog
+import socket
 import getpass
+import threading
+import weakref
+import contextlib
+import gevent
+import gevent.pool
+import gevent.socket
 import websocket as ws
+from collections import namedtuple
+from gevent.event import AsyncResult, Event
+
+# logger for this module; a handler is attached by the first Telescope
+log = logging.getLogger('telescope')
+
+# the values making up the current weather
+WeatherSnapshot = namedtuple('WeatherSnapshot', 'cloud dew rain sun_alt moon_alt')
+
+# the (missing, unexpected) weather keys already warned about
+_weather_mismatches = set()
+
+
+def _weather_snapshot(weather):
+    """ Return {weather} as a WeatherSnapshot if it is a dictionary
+    of weather values, and unchanged otherwise.
+
+    Missing values are None and values the snapshot has no field for are
+    dropped; both are logged, once, since they mean the server's reply changed.
+    """
+    if not isinstance(weather, dict):
+        return weather
+
+    missing = tuple(field for field in WeatherSnapshot._fields if field not in weather)
+    extra = tuple(key for key in weather if key not in WeatherSnapshot._fields)
+    if (missing or extra) and (missing, extra) not in _weather_mismatches:
+        _weather_mismatches.add((missing, extra))
+        log.warning('Weather from TelescopeServer is missing %s and has unexpected %s', missing, extra)
+
+    return WeatherSnapshot._make(map(weather.get, WeatherSnapshot._fields))
+
+
+# ANSI colour codes for each log level, the same as colorlog's defaults
+_LOG_COLORS = {logging.DEBUG: '\x1b[37m',
+               logging.INFO: '\x1b[32m',
+               logging.WARNING: '\x1b[33m',
+               logging.ERROR: '\x1b[31m',
+               logging.CRITICAL: '\x1b[1;31m'}
+
+
+class _ColoredFormatter(logging.Formatter):
+    """ Format log records in the colour of their level.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return f'{_LOG_COLORS.get(record.levelno, "")}{super().format(record)}\x1b[0m'
+
+
+# port of the TelescopeServer and its URI, resolved once at import; an
+# invalid ATLAS_WS_PORT is only reported once we try and connect
+_PORT_SPEC = (os.environ.get('ATLAS_WS_PORT') or '27404').strip()
+_DEFAULT_PORT = int(_PORT_SPEC) if _PORT_SPEC.isdigit() and 0 < int(_PORT_SPEC) < 65536 else None
+_URI_FMT = '{}://{}:{}'.format
+
+
+def _server_port() -> int:
+    """ Return the port of the TelescopeServer, raising if ATLAS_WS_PORT
+    isn't a valid port number.
+    """
+    if _DEFAULT_PORT is None:
+        log.critical('ATLAS_WS_PORT must be a port number, not %r', _PORT_SPEC)
+        raise Exception(f'ATLAS_WS_PORT must be a port number, not {_PORT_SPEC!r}')
+
+    return _DEFAULT_PORT
+
+# frames sent on a connection are buffered until there are this many
+# bytes, or until this many seconds have passed since the first one
+_WRITE_BUFFER_SIZE = 4096
+_WRITE_DELAY = 0.002
+
+# every writer that may still hold unsent frames, flushed at exit
+_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_writers() -> None:
+    """ Send any frames still buffered when the interpreter exits.
+    """
+    for writer in list(_writers):
+        try:
+            writer.flush()
+        except Exception as e:
+            log.warning('Unable to send to TelescopeServer: %s', e)
+
+# socket options for the connection to the TelescopeServer. Command messages
+# are small, so send them immediately rather than letting Nagle's algorithm
+# hold them back; callers that want throughput should use `Telescope.batch`.
+_SOCKOPT = ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, 64*1024),
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, 64*1024))
+
+# serialized start of the message running each command, built the
+# first time the command is run
+_PREFIXES = {}
+
+
+def _command_prefix(command: str) -> bytes:
+    """ Return the serialized start of every message running {command}.
+    """
+    prefix = _PREFIXES.get(command)
+    if prefix is None:
+        prefix = _PREFIXES[command] = b'{"command":%s,"id":' % orjson.dumps(command)
+
+    return prefix
+
+
+# message keys that command arguments would overwrite
+_RESERVED_ARGS = frozenset(('command', 'id'))
+
+
+def _build_msg(prefix: bytes, request_id: int, kwargs: dict) -> bytes:
+    """ Serialize the message with request id {request_id} running the
+    command whose message starts with {prefix}, with arguments {kwargs}.
+    """
+    if kwargs:
+        # arguments share the message with the command and its id
+        reserved = _RESERVED_ARGS.intersection(kwargs)
+        if reserved:
+            raise Exception(f'{", ".join(sorted(reserved))} cannot be used as a command argument')
+
+        # append the arguments in place of their opening brace
+        return b'%s%d,%s' % (prefix, request_id, orjson.dumps(kwargs)[1:])
+
+    # most commands take no arguments, so only the id needs formatting
+    return b'%s%d}' % (prefix, request_id)
+
+
+def _parse_reply(reply: dict, print_results: bool = False):
+    """ Check whether a reply from the TelescopeServer was successful
+    and return its result.
+    """
+    if not reply.get('success'):
+        reason = reply.get('result') or 'unknown reason'
+        log.warning('Unable to execute command: %s', reason)
+        return None
+
+    # print result
+    if print_results:
+        log.info('%s', reply.get('result'))
+
+    # return it for processing by other methods
+    return reply.get('result')
+
+
+class _BufferedWriter(object):
+    """ Coalesce the frames sent on a websocket, so that commands sent
+    in a burst are written to the socket together.
+
+    Frames are written once {size} bytes are buffered, or {delay} seconds
+    after the first frame was buffered, whichever comes first. The timer
+    only fires once the sender yields, so callers that don't immediately
+    wait on a reply should send with {now} set. If a write
+    fails, {on_error} is called with the exception, since the frames it
+    dropped may belong to commands that are still waiting on a reply.
+    """
+
+    __slots__ = ('websocket', 'on_error', 'size', 'delay', '_buffer', '_timer', '__weakref__')
+
+    def __init__(self, websocket: ws.WebSocket, on_error, size: int = _WRITE_BUFFER_SIZE,
+                 delay: float = _WRITE_DELAY):
+        self.websocket = websocket
+        self.on_error = on_error
+        self.size = size
+        self.delay = delay
+        self._buffer = bytearray()
+        self._timer = None
+        _writers.add(self)
+
+    def send(self, payload: bytes, now: bool = False) -> None:
+        """ Buffer a text frame containing {payload}, and write it along
+        with the rest of the buffer straight away if {now} is True.
+        """
+        self._buffer += ws.ABNF.create_frame(payload, ws.ABNF.OPCODE_TEXT).format()
+
+        if now or len(self._buffer) >= self.size:
+            self.flush()
+        elif not self._timer:
+            self._timer = gevent.spawn_later(self.delay, self.__flush_later)
+
+    def flush(self) -> None:
+        """ Write every buffered frame to the socket at once.
+        """
+        timer, self._timer = self._timer, None
+        if timer and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+
+        if self._buffer:
+            data, self._buffer = self._buffer, bytearray()
+            try:
+                with self.websocket.lock:
+                    self.websocket.sock.sendall(data)
+            except Exception as e:
+                self.on_error(e)
+                raise
+
+    def __flush_later(self) -> None:
+        """ Flush the buffer once the delay has passed.
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            log.warning('Unable to send to TelescopeServer: %s', e)
+
+
+def _init_log() -> bool:
+    """ Initialize the logging system for this module, coloring
+    the output when logging to a terminal. 
+    """
+    # create format string for this module
+    fmt = '%(asctime)s [%(levelname)s] [name]: %(message)s'
+    datefmt = '%Y-%m-%d %H:%M:%S'
+    format_str = fmt.replace('[name]', 'TELESCOPE')
+
+    # create stream
+    stream = logging.StreamHandler()
+    stream.setLevel(logging.DEBUG)
+
+    # only colorize output that a person is going to read
+    formatter = _ColoredFormatter if stream.stream.isatty() else logging.Formatter
+    stream.setFormatter(formatter(format_str, datefmt=datefmt))
+
+    # set handler
+    log.setLevel(logging.DEBUG)
+    log.addHandler(stream)
+
+    return True
 
 
 class Telescope(object):
 
-    # logger for class
-    log = None
+    # every attribute set on an instance; avoids a per-instance __dict__
+    __slots__ = ('websocket', 'print_results', '_pool_key', '_pw_hash', '_pending',
+                 '_writer', '_ids', '_inflight', '_max_inflight', '_slot_freed', '_reader', '_pong',
+                 '_monitor_cache')
+
+    # idle connections to the TelescopeServer and the request ids they will
+    # use next, keyed by (username, host, port, secure) so that
+    # a secure session is never handed a plaintext connection
+    _pool = {}
+    _pool_lock = threading.Lock()
 
-    def __init__(self, username: str, host: str, secure: bool = True, print_results: bool = False):
+    def __init__(self, username: str, host: str, secure: bool = True, print_results: bool = False,
+                 max_inflight: int = 16):
         """ Create a new Telescope object by connecting to the TelescopeServer, 
         authenticating a new control session, and initializing the logging system. 
+
+        At most {max_inflight} commands are sent before their replies arrive;
+        further commands wait until a reply frees up a slot.
         """
 
         # initialize logging system if not already done
-        if not Telescope.log:
-            Telescope.__init_log()
+        if not log.handlers:
+            _init_log()
 
         # initialize unconnected websocket
         self.websocket = None
+        self._writer = None
+        self._pool_key = None
+
+        # hash of the password, so that reconnecting doesn't prompt again
+        self._pw_hash = None
+
+        # commands queued by `batch`, keyed by the greenlet batching them
+        self._pending = {}
+
+        # commands waiting on a reply, keyed by their request id; ids belong
+        # to the connection so replies for a previous owner can't be mistaken
+        self._ids = None
+        self._inflight = {}
+
+        # limit on commands awaiting a reply, and set whenever one is answered
+        self._max_inflight = max_inflight
+        self._slot_freed = Event()
+
+        # greenlet receiving replies from the TelescopeServer
+        self._reader = None
+
+        # set by the reader when the server answers our ping
+        self._pong = Event()
+
+        # latest sensor values pushed by `subscribe`
+        self._monitor_cache = {}
 
         # whether we should always print raw command results
         self.print_results = print_results
@@ -32,380 +305,676 @@ class Telescope(object):
         self.connect(username, host, secure)
 
     def connect(self, username: str, host: str, secure: bool = True) -> bool:
-        """ Try and connect to the TelescopeServer 
+        """ Try and connect to the TelescopeServer, reusing an idle
+        connection to the same server if one is available.
         """
+        # get port spec
+        port: int = _server_port()
+
+        # check for an idle connection from a previous session
+        self._pool_key = (username, host, port, secure)
+        with Telescope._pool_lock:
+            websocket, ids = Telescope._pool.pop(self._pool_key, (None, None))
+
+        # only reuse it if the server still answers on it
+        if websocket:
+            self.websocket = websocket
+            self._ids = ids
+            self._writer = _BufferedWriter(websocket, self.__fail_send)
+            self.__start_reader()
+            if self.is_alive():
+                return True
+            self.__stop_reader()
+            self.websocket = self._writer = None
+            websocket.close()
+
+        # only ask for the password the first time we connect
+        if not self._pw_hash:
+            self._pw_hash = self._prompt_and_hash()
+
         # try and create connection
-        websocket: ws.WebSocket = self.__connect(username, host, secure)
+        websocket = self.__connect(username, host, port, secure, self._pw_hash)
 
         # if valid connection
         if websocket:
             self.websocket = websocket
+            self._ids = itertools.count(1)
+            self._writer = _BufferedWriter(websocket, self.__fail_send)
+            self.__start_reader()
             return True
 
         # otherwise we failed
         return False
 
     @staticmethod
-    def __connect(username: str, host: str, secure: bool) -> ws.WebSocket:
+    def _prompt_and_hash() -> str:
+        """ Ask the user for their password and return its sha256 hash.
+        """
+        plain_password: str = getpass.getpass('Atlas Password: ').encode('utf8')
+
+        # must encrypt with sha256 before sending
+        return hashlib.sha256(plain_password).digest().hex()
+
+    @staticmethod
+    def __connect(username: str, host: str, port: int, secure: bool, pw_hash: str = None) -> ws.WebSocket:
         """ Try and create a connection to the TelescopeServer and
-        return the connected websocket. 
+        return the connected websocket. The user is prompted for
+        their password if {pw_hash} is not given.
         """
         try:
-            # get port spec
-            port: int = os.environ.get('ATLAS_WS_PORT') or 27404
-
             # by default, use wss
             protocol: str = 'wss'
             if not secure:
                 protocol = 'ws'
                 
             # try and connect to telescope server
-            uri: str = f'{protocol}://{host}:{port}'
-            websocket = ws.create_connection(uri)
+            uri: str = _URI_FMT(protocol, host, port)
+            # orjson validates UTF-8 as it parses, so skip the library's check
+            websocket = ws.create_connection(uri, sockopt=_SOCKOPT, skip_utf8_validation=True)
 
             # send username and password
-            plain_password: str = getpass.getpass('Atlas Password: ').encode('utf8')
-
-            # must encrypt with sha256 before sending
-            password = hashlib.sha256(plain_password).hexdigest()
+            if not pw_hash:
+                pw_hash = Telescope._prompt_and_hash()
             msg = {'action': 'connect',
                    'email': username,
-                   'password': password}
-            websocket.send(json.dumps(msg))
+                   'password': pw_hash}
+            websocket.send(orjson.dumps(msg))
 
             # wait for connection message
-            reply = json.loads(websocket.recv())
+            _, data = websocket.recv_data()
+            reply = orjson.loads(data)
 
             if reply.get('connected'):
-                Telescope.log.info('Successfully connected to TelescopeServer')
+                log.info('Successfully connected to TelescopeServer')
             else:
                 reason = reply.get('result') or 'unknown'
-                Telescope.log.warning(f'Telescope is currently unavailable: {reason}')
-        except json.decoder.JSONDecodeError as e:
-            Telescope.log.critical(f'Did not receive valid response from TelescopeServer.')
+                log.warning('Telescope is currently unavailable: %s', reason)
+        except orjson.JSONDecodeError as e:
+            log.critical('Did not receive valid response from TelescopeServer.')
             raise Exception(f'Did not receive valid response from TelescopeServer.')
         except Exception as e:
-            Telescope.log.critical(f'Error occurred in connecting to TelescopeServer: {e}')
+            log.critical('Error occurred in connecting to TelescopeServer: %s', e)
             raise Exception(f'Unable to connect to TelescopeServer: {e}')
 
         return websocket
 
     def is_alive(self) -> bool:
-        """ Check whether connection to telescope server is alive/working, and whether
-        we still have permission to execute commands. 
+        """ Check whether connection to telescope server is alive/working. 
+
+        This sends a WebSocket ping and waits up to a second for the pong,
+        falling back to the `is_alive` command if the server doesn't answer it.
         """
+        # nothing will answer if we aren't reading from the connection
+        if not self.__connected():
+            return False
+
         try:
-            self.run_command('is_alive')
+            pong = self._pong = Event()
+            self.websocket.ping()
+            if pong.wait(timeout=1.0):
+                return True
+
+            # send the command now even if we are inside a batch
+            greenlet = gevent.getcurrent()
+            batched = self._pending.pop(greenlet, None)
+            try:
+                result = self.run_command_async('is_alive')
+            finally:
+                if batched is not None:
+                    self._pending[greenlet] = batched
+
+            try:
+                result.get(timeout=1.0)
+            except gevent.Timeout:
+                # stop waiting on a reply that may never come
+                for request_id, pending in list(self._inflight.items()):
+                    if pending is result:
+                        del self._inflight[request_id]
+                self._slot_freed.set()
+                raise Exception('TelescopeServer did not answer is_alive')
             return True
         except Exception as e:
-            self.log.warning(f'{e}')
+            log.warning('%s', e)
             return False
 
     def disconnect(self) -> bool:
         """ Disconnect the Telescope from the TelescopeServer. 
-        """
-        self.websocket.close()
 
-        return True
+        The connection is kept idle so that the next Telescope connecting
+        to the same server can reuse it; use `shutdown_pool` to close it.
+        """
+        # send anything still buffered before we stop listening for replies
+        if self._writer:
+            try:
+                self._writer.flush()
+            except Exception as e:
+                log.warning('Unable to send to TelescopeServer: %s', e)
+            self._writer = None
+
+        self.__stop_reader()
+        self._monitor_cache.clear()
+        websocket, self.websocket = self.websocket, None
+
+        # return the connection to the pool, replacing any older idle one
+        if websocket and websocket.connected:
+            with Telescope._pool_lock:
+                idle, _ = Telescope._pool.get(self._pool_key, (None, None))
+                Telescope._pool[self._pool_key] = (websocket, self._ids)
+            if idle:
+                idle.close()
 
-    def open_dome(self) -> bool:
-        """ Checks that the weather is acceptable using `weather_ok`, 
-        and if the dome is not already open. opens the dome. 
+        return True
 
-        Returns True if the dome was opened, False otherwise.
+    @classmethod
+    def shutdown_pool(cls) -> bool:
+        """ Close every idle connection to the TelescopeServer. 
         """
-        return self.run_command('open_dome')
+        with cls._pool_lock:
+            idle = list(cls._pool.values())
+            cls._pool.clear()
 
-    def dome_open(self) -> bool:
-        """ Checks whether the telescope slit is open or closed. 
+        for websocket, _ in idle:
+            websocket.close()
 
-        Returns True if open, False if closed. 
-        """
-        return self.run_command('dome_open')
+        return True
 
-    def close_dome(self) -> bool:
-        """ Closes the dome, but leaves the session connected. Returns
-        True if successful in closing down, False otherwise.
+    def get_cloud(self, fresh: bool = False) -> float:
+        """ Get the current cloud coverage. If subscribed to 'cloud',
+        return the latest pushed value unless {fresh} is True.
         """
-        return self.run_command('close_dome')
+        return self.__monitored('cloud', fresh)
 
-    def close_down(self) -> bool:
-        """ Closes the dome and unlocks the telescope. Call
-        this at end of every control session. 
+    def get_dew(self, fresh: bool = False) -> float:
+        """ Get the current dew value. If subscribed to 'dew',
+        return the latest pushed value unless {fresh} is True.
         """
-        return self.run_command('close_down')
+        return self.__monitored('dew', fresh)
 
-    def lock(self, user: str, comment: str = 'observing') -> bool:
-        """ Lock the telescope with the given username. 
+    def get_rain(self, fresh: bool = False) -> float:
+        """ Get the current rain value. If subscribed to 'rain',
+        return the latest pushed value unless {fresh} is True.
         """
-        return self.run_command('lock', user = user, comment = comment)
+        return self.__monitored('rain', fresh)
 
-    def unlock(self) -> bool:
-        """ Unlock the telescope if you have the lock. 
+    def get_sun_alt(self, fresh: bool = False) -> float:
+        """ Get the current altitude of the sun. If subscribed to 'sun_alt',
+        return the latest pushed value unless {fresh} is True.
         """
-        return self.run_command('unlock')
+        return self.__monitored('sun_alt', fresh)
 
-    def locked(self) -> (bool, str):
-        """ Check whether the telescope is locked. If it is, 
-        return the username of the lock holder. 
+    def get_moon_alt(self, fresh: bool = False) -> float:
+        """ Get the current altitude of the moon. If subscribed to 'moon_alt',
+        return the latest pushed value unless {fresh} is True.
         """
-        return self.run_command('locked')
+        return self.__monitored('moon_alt', fresh)
 
-    def keep_open(self, time: int) -> bool:
-        """ Keep the telescope dome open for {time} seconds. 
-        Returns True if it was successful. 
+    def get_weather(self, fresh: bool = False) -> WeatherSnapshot:
+        """ Extract all the values for the current weather 
+        and return them as a WeatherSnapshot. If subscribed to 'weather',
+        return the latest pushed value unless {fresh} is True.
+
+        Only this method converts the reply; `run_command('get_weather')`,
+        `run_commands` and `batch` return the server's raw dictionary.
         """
-        return self.run_command('keep_open', time = time)
+        return _weather_snapshot(self.__monitored('weather', fresh))
+
+    def subscribe(self, names: list, hz: float = 1.0) -> bool:
+        """ Ask the TelescopeServer to push the values of the sensors
+        in {names}, i.e. ['cloud', 'rain'], {hz} times a second. 
 
-    def get_cloud(self) -> float:
-        """ Get the current cloud coverage.
+        Once subscribed, the matching getters return the latest
+        pushed value without contacting the server.
         """
-        return self.run_command('get_cloud')
+        return self.run_command('subscribe', names=names, hz=hz)
 
-    def get_dew(self) -> float:
-        """ Get the current dew value.
+    def __monitored(self, name: str, fresh: bool):
+        """ Return the latest pushed value of the sensor {name}, or ask the
+        server for it if we aren't subscribed to it or {fresh} is True.
         """
-        return self.run_command('get_dew')
+        if not fresh and gevent.getcurrent() not in self._pending and name in self._monitor_cache:
+            return self._monitor_cache[name]
 
-    def get_rain(self) -> float:
-        """ Get the current rain value.
+        return self.run_command(f'get_{name}')
+
+    def get_weather_bundle(self) -> WeatherSnapshot:
+        """ Get the cloud, dew, rain, sun altitude and moon altitude
+        concurrently over the same connection and return them as a
+        WeatherSnapshot. 
         """
-        return self.run_command('get_rain')
+        getters = (self.get_cloud, self.get_dew, self.get_rain, self.get_sun_alt, self.get_moon_alt)
+
+        return WeatherSnapshot._make(gevent.pool.Group().map(lambda getter: getter(), getters))
 
-    def get_sun_alt(self) -> float:
-        """ Get the current altitude of the sun. 
+    def offset(self, dra: float, ddec: float) -> bool:
+        """ Offset the pointing of the telescope by a given
+        dRa and dDec
         """
-        return self.run_command('get_sun_alt')
+        return self.run_command('offset', ra=dra, dec=ddec)
 
-    def get_moon_alt(self) -> float:
-        """ Get the current altitude of the moon. 
+    def offset_sequence(self, dras: list, ddecs: list) -> bool:
+        """ Offset the pointing of the telescope by each (dRa, dDec)
+        pair in turn, i.e. for a dither pattern, using a single message.
+
+        Parameters
+        ----------
+        dras: list
+            The offsets in right-ascension
+        ddecs: list
+            The offsets in declination, one for each offset in {dras}
         """
-        return self.run_command('get_moon_alt')
+        if len(dras) != len(ddecs):
+            raise Exception(f'Got {len(dras)} offsets in RA but {len(ddecs)} in Dec')
 
-    def get_weather(self) -> dict:
-        """ Extract all the values for the current weather 
-        and return it as a python dictionary. 
+        # convert to python floats so numpy and array inputs serialize
+        pairs = [[float(dra), float(ddec)] for dra, ddec in zip(dras, ddecs)]
+
+        return self.run_command('offset_sequence', pairs=pairs)
+
+    def take_flats(self) -> bool:
+        """ Wait until the weather is good for flats, and then take a series of
+        flats before returning. 
         """
-        return self.run_command('get_weather')
+        return flats.take_flats(self)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Queue every command run inside this block and send them
+        to the TelescopeServer in a single message when the block exits.
+
+        Commands run inside the block return an `AsyncResult` whose
+        value can be retrieved with `get()` once the block has exited.
+        Only the greenlet that opened the block has its commands queued;
+        other greenlets keep sending theirs straight away.
 
-    def weather_ok(self) -> bool:
-        """ Checks whether the sun has set, there is no rain (rain=0) and that
-        it is less than 30% cloudy. Returns true if the weather is OK to open up,
-        false otherwise.
+        >>> with telescope.batch():
+        >>>     opened = telescope.open_dome()
+        >>>     pointed = telescope.goto_target('M31')
+        >>> opened.get(), pointed.get()
         """
-        return self.run_command('weather_ok')
+        greenlet = gevent.getcurrent()
+        outer = self._pending.get(greenlet)
+        pending = self._pending[greenlet] = []
+        try:
+            yield self
+        except Exception:
+            # the batch is never sent, so nothing will answer these
+            for request_id, _ in pending:
+                self._inflight.pop(request_id, None)
+            raise
+        finally:
+            if outer is None:
+                del self._pending[greenlet]
+            else:
+                self._pending[greenlet] = outer
 
-    def goto_target(self, target: str) -> (bool, float, float):
-        """ Point the telescope at a target.
-        
-        Point the telescope at the target given
-        by the catalog name {target} using the pinpoint
-        algorithm to ensure pointing accuracy. Valid 
-        target names include 'M1', 'm1', 'NGC6946', etc.
+        # join the serialized messages rather than serializing them again
+        if pending:
+            if not self.__connected():
+                for request_id, _ in pending:
+                    self._inflight.pop(request_id, None)
+                raise Exception('Not connected to TelescopeServer')
+            self._writer.send(b'{"batch":[%s]}' % b','.join(msg for _, msg in pending), now=True)
+
+    def run_commands(self, commands: list) -> list:
+        """ Run several commands on the telescope server using
+        a single message and a single reply.
 
         Parameters
         ----------
-        target: str
-            The name of the target that you want to observe
+        commands: list
+            The messages to send, i.e. [{'command': 'goto_target', 'target': 'M31'}]
 
         Returns
         -------
-        success: bool
-            Whether pinpointing was a success
-        dra: float
-            The final offset error in right-ascension
-        ddec: float
-            The final offset error in declination
+        results: list
+            The result of each command, in the order they were given
         """
-        return self.run_command('goto_target', target=target)
+        with self.batch():
+            results = [self.run_command_async(**msg) for msg in commands]
+
+        return [result.get() for result in results]
+
+    def run_command(self, command: str, *_, **kwargs):
+        """ Run a command on the telescope server. 
+        
+        This is done by sending message via websocket to
+        the TelescopeServer, that then executes the command
+        via SSH, and returns the string via WebSocket.
 
-    def goto_point(self, ra: str, dec: str) -> (bool, float, float):
-        """ Point the telescope at a given RA/Dec. 
+        Waiting for the reply yields to other greenlets, so
+        commands run from several greenlets execute concurrently.
+         
+        Parameters
+        ----------
+        command: str
+            The command to be run
         
-        Point the telescope at the given RA/Dec using the pinpoint
-        algorithm to ensure good pointing accuracy. Format
-        for RA/Dec is hh:mm:ss, dd:mm:ss
+        """
+        return self._send(_command_prefix(command), kwargs)
+
+    def run_command_async(self, command: str, *_, **kwargs) -> AsyncResult:
+        """ Send a command to the telescope server without waiting
+        for its reply. 
+
+        Several commands can be sent before any of them is answered;
+        each reply is matched to its command by request id.
 
         Parameters
         ----------
-        ra: float
-            The right-ascension of the desired target
-        dec: float
-            The declination of the desired target
+        command: str
+            The command to be run
 
         Returns
         -------
-        success: bool
-            Whether pinpointing was a success
-        dra: float
-            The final offset error in right-ascension
-        ddec: float
-            The final offset error in declination
+        result: AsyncResult
+            Holds the result of the command once its reply has arrived
         """
-        return self.run_command('goto_point', ra=ra, dec=dec)
+        return self._send(_command_prefix(command), kwargs, wait=False)
 
-    def target_visible(self, target: str) -> bool:
-        """ Check whether a target is visible using
-        the telescope controller commands. 
-        """
-        return self.run_command('target_visible', target=target)
+    # commands are pipelined: send several with this, then wait on their results
+    run_command_nowait = run_command_async
 
-    def point_visible(self, ra: str, dec: str) -> bool:
-        """ Check whether a given RA/Dec pair is visible. 
-        """
-        return self.run_command('point_visible', ra=ra, dec=dec)
+    def _send(self, prefix: bytes, kwargs: dict, wait: bool = True):
+        """ Send the command whose serialized message starts with {prefix}.
 
-    def target_altaz(self, target: str) -> (float, float):
-        """ Return a (alt, az) pair containing floats indicating
-        the altitude and azimuth of a target - i.e 'M31', 'NGC4779'
+        Returns the result of the command, or its `AsyncResult` if
+        {wait} is False or the command is queued by `batch`.
         """
-        return self.run_command('target_altaz', target=target)
 
-    def point_altaz(self, ra: str, dec: str) -> (float, float):
-        return self.run_command('point_altaz', ra=ra, dec=dec)
+        # wait until there is room in the in-flight window; batched
+        # commands are exempt as they can't be answered until sent
+        pending = self._pending.get(gevent.getcurrent())
+        while pending is None and len(self._inflight) >= self._max_inflight:
+            self._slot_freed.clear()
+            self._slot_freed.wait()
 
-    def offset(self, dra: float, ddec: float) -> bool:
-        """ Offset the pointing of the telescope by a given
-        dRa and dDec
-        """
-        return self.run_command('offset', ra=ra, dec=dec)
+        # nothing would ever answer a command sent on a dead connection
+        if not self.__connected():
+            raise Exception('Not connected to TelescopeServer')
 
-    def enable_tracking(self) -> bool:
-        """ Enable the tracking motor for the telescope.
-        """
-        return self.run_command('enable_tracking')
+        # build message, tagged with an id so that we can match its reply
+        request_id = next(self._ids)
+        msg = _build_msg(prefix, request_id, kwargs)
 
-    def calibrate_motors(self) -> bool:
-        """ Run the motor calibration routine. 
-        """
-        return self.run_command('calibrate_motors')
+        # register the command before sending so the reply can't be missed
+        result = self._inflight[request_id] = AsyncResult()
 
-    def get_focus(self) -> float:
-        """ Return the current focus value of the
-        telescope.
-        """
-        return self.run_command('get_focus')
+        # if we are batching, queue the message until the batch is sent
+        if pending is not None:
+            pending.append((request_id, msg))
+            return result
 
-    def set_focus(self, focus: float) -> bool:
-        """ Set the focus value of the telescope to
-        {focus}. 
-        """
-        return self.run_command('set_focus', focus=focus)
+        # send message on websocket; waiting on the reply yields, which lets
+        # the writer coalesce it with any others sent in the meantime
+        self._writer.send(msg, now=not wait)
 
-    def auto_focus(self) -> bool:
-        """ Automatically focus the telescope
-        using the focus routine. 
-        """
-        return self.run_command('auto_focus')
-
-    def current_filter(self) -> str:
-        """ Return the string name of the current filter. 
-        """
-        return self.run_command('current_filter')
+        return result.get() if wait else result
 
-    def change_filter(self, name: str) -> bool:
-        """ Change the current filter specified by {filtname}.
+    def __connected(self) -> bool:
+        """ Check whether we have a connection whose replies are being received.
         """
-        return self.run_command('change_filter', name=name)
+        return bool(self.websocket and self.websocket.connected
+                    and self._reader and not self._reader.dead)
 
-    def make_dir(self, dirname: str) -> bool:
-        """ Make a directory on the telescope control server. 
+    def __start_reader(self) -> None:
+        """ Start the greenlet that receives replies from the TelescopeServer.
         """
-        return self.run_command('make_dir', dirname=dirname)
+        self._reader = gevent.spawn(self.__reader_loop, self.websocket)
 
-    def take_flats(self) -> bool:
-        """ Wait until the weather is good for flats, and then take a series of
-        flats before returning. 
+    def __stop_reader(self) -> None:
+        """ Stop receiving replies and fail any command still waiting on one.
         """
-        return flats.take_flats(self)
+        if self._reader:
+            self._reader.kill()
+            self._reader = None
 
-    def wait(self, wait: int) -> None:
-        """ Sleep the telescope for 'wait' seconds. 
+        self.__fail_inflight(Exception('Disconnected from TelescopeServer'))
 
-        If the time is over telescope.wait_time, shutdown the telescope
-        while we wait, and then reopen before returning. 
+    def __fail_inflight(self, error: Exception) -> None:
+        """ Raise {error} in every command still waiting on a reply. 
         """
-        return self.run_command('wait', wait=wait)
-        
-    def wait_until_good(self) -> bool:
-        """ Wait until the weather is good for observing.
-        """
-        return self.run_command('wait_until_good')
-            
-    def take_exposure(self, filename: str, exposure_time: int, count: int = 1, binning: int = 2) -> bool:
-        """ Take a full set of dark frames for a given session. Takes exposure_count
-        dark frames.
-        """
-        return self.run_command('take_exposure', filename=filename, exposure_time=exposure_time,
-                                count=count, binning=binning)
-    
-    def take_dark(self, filename: str, exposure_time: int, count: int = 1, binning: int = 2) -> bool:
-        """ Take a full set of dark frames for a given session. Takes exposure_count
-        dark frames.
-        """
-        return self.run_command('take_dark', filename=filename, exposure_time=exposure_time,
-                                count=count, binning=binning)
+        inflight, self._inflight = self._inflight, {}
+        for result in inflight.values():
+            result.set_exception(error)
+        self._slot_freed.set()
 
-    def take_bias(self, filename: str, count: int = 1, binning: int = 2) -> bool:
-        """ Take the full set of biases for a given session.
-        This takes exposure_count*numbias biases
+    def __fail_send(self, error: Exception) -> None:
+        """ Fail every command waiting on a reply once the frames carrying
+        them could not be written to the TelescopeServer.
         """
-        return self.run_command('take_bias', filename=filename, count=count, binning=binning)
+        self.__fail_inflight(Exception(f'Unable to send to TelescopeServer: {error}'))
 
-    def run_command(self, command: str, *_, **kwargs):
-        """ Run a command on the telescope server. 
-        
-        This is done by sending message via websocket to
-        the TelescopeServer, that then executes the command
-        via SSH, and returns the string via WebSocket.
-         
-        Parameters
-        ----------
-        command: str
-            The command to be run
-        
+    def __reader_loop(self, websocket: ws.WebSocket) -> None:
+        """ Receive replies from the TelescopeServer and pass each
+        one to the command that is waiting on it.
         """
-
-        # build message
-        msg = {'command': command, **kwargs}
-
-        # send message on websocket
-        self.websocket.send(json.dumps(msg))
-
-        # receive result of command
-        reply = json.loads(self.websocket.recv())
-
-        if not reply.get('success'):
-            reason = reply.get('result') or 'unknown reason'
-            self.log.warning(f'Unable to execute command: {reason}')
-            return None
-
-        # print result
-        if self.print_results:
-            self.log.info(reply.get('result'))
-
-        # return it for processing by other methods
-        return reply.get('result')
-
-    @classmethod
-    def __init_log(cls) -> bool:
-        """ Initialize the logging system for this module and set
-        a ColoredFormatter. 
-        """
-        # create format string for this module
-        fmt = '%(log_color)s%(asctime)s [%(levelname)s] [name]: %(message)s%(reset)s'
-        datefmt = '%Y-%m-%d %H:%M:%S'
-        format_str = fmt.replace('[name]', 'TELESCOPE')
-        formatter = colorlog.ColoredFormatter(format_str, datefmt=datefmt)
-
-        # create stream
-        stream = logging.StreamHandler()
-        stream.setLevel(logging.DEBUG)
-        stream.setFormatter(formatter)
-
-        # assign log method and set handler
-        cls.log = logging.getLogger('telescope')
-        cls.log.setLevel(logging.DEBUG)
-        cls.log.addHandler(stream)
-
-        return True
+        try:
+            while True:
+                # yield to other greenlets until there is data to read
+                sock = websocket.sock
+                if not (isinstance(sock, ssl.SSLSocket) and sock.pending()):
+                    gevent.socket.wait_read(sock.fileno())
+
+                # receive result of command, or a control frame
+                opcode, data = websocket.recv_data(control_frame=True)
+                if opcode == ws.ABNF.OPCODE_PONG:
+                    self._pong.set()
+                    continue
+                elif opcode == ws.ABNF.OPCODE_PING:
+                    continue
+                elif opcode == ws.ABNF.OPCODE_CLOSE:
+                    raise Exception('connection closed by server')
+
+                reply = orjson.loads(data)
+
+                # values pushed by a subscription aren't a reply to any command
+                if isinstance(reply, dict) and 'update' in reply:
+                    update = reply['update']
+                    if 'weather' in update:
+                        update['weather'] = _weather_snapshot(update['weather'])
+                    self._monitor_cache.update(update)
+                    continue
+
+                # a batch is answered with a list of replies
+                for r in (reply if isinstance(reply, list) else [reply]):
+                    result = self._inflight.pop(r.get('id'), None)
+                    if result:
+                        result.set(_parse_reply(r, self.print_results))
+                        self._slot_freed.set()
+                    else:
+                        log.warning('Received unexpected reply from TelescopeServer: %s', r)
+        except Exception as e:
+            log.warning('Lost connection to TelescopeServer: %s', e)
+            self.__fail_inflight(Exception(f'Lost connection to TelescopeServer: {e}'))
+
+
+# commands that only pass their arguments on to the TelescopeServer, as
+# (name, arguments, return type, docstring); each argument is a (name, type)
+# or (name, type, default) tuple
+_COMMANDS = (
+    ('open_dome', (), bool,
+     """ Checks that the weather is acceptable using `weather_ok`, 
+     and if the dome is not already open. opens the dome. 
+
+     Returns True if the dome was opened, False otherwise.
+     """),
+    ('dome_open', (), bool,
+     """ Checks whether the telescope slit is open or closed. 
+
+     Returns True if open, False if closed. 
+     """),
+    ('close_dome', (), bool,
+     """ Closes the dome, but leaves the session connected. Returns
+     True if successful in closing down, False otherwise.
+     """),
+    ('close_down', (), bool,
+     """ Closes the dome and unlocks the telescope. Call
+     this at end of every control session. 
+     """),
+    ('lock', (('user', str), ('comment', str, 'observing')), bool,
+     """ Lock the telescope with the given username. 
+     """),
+    ('unlock', (), bool,
+     """ Unlock the telescope if you have the lock. 
+     """),
+    ('locked', (), (bool, str),
+     """ Check whether the telescope is locked. If it is, 
+     return the username of the lock holder. 
+     """),
+    ('keep_open', (('time', int),), bool,
+     """ Keep the telescope dome open for {time} seconds. 
+     Returns True if it was successful. 
+     """),
+    ('weather_ok', (), bool,
+     """ Checks whether the sun has set, there is no rain (rain=0) and that
+     it is less than 30% cloudy. Returns true if the weather is OK to open up,
+     false otherwise.
+     """),
+    ('goto_target', (('target', str),), (bool, float, float),
+     """ Point the telescope at a target.
+     
+     Point the telescope at the target given
+     by the catalog name {target} using the pinpoint
+     algorithm to ensure pointing accuracy. Valid 
+     target names include 'M1', 'm1', 'NGC6946', etc.
+
+     Parameters
+     ----------
+     target: str
+         The name of the target that you want to observe
+
+     Returns
+     -------
+     success: bool
+         Whether pinpointing was a success
+     dra: float
+         The final offset error in right-ascension
+     ddec: float
+         The final offset error in declination
+     """),
+    ('goto_point', (('ra', str), ('dec', str)), (bool, float, float),
+     """ Point the telescope at a given RA/Dec. 
+     
+     Point the telescope at the given RA/Dec using the pinpoint
+     algorithm to ensure good pointing accuracy. Format
+     for RA/Dec is hh:mm:ss, dd:mm:ss
+
+     Parameters
+     ----------
+     ra: float
+         The right-ascension of the desired target
+     dec: float
+         The declination of the desired target
+
+     Returns
+     -------
+     success: bool
+         Whether pinpointing was a success
+     dra: float
+         The final offset error in right-ascension
+     ddec: float
+         The final offset error in declination
+     """),
+    ('target_visible', (('target', str),), bool,
+     """ Check whether a target is visible using
+     the telescope controller commands. 
+     """),
+    ('point_visible', (('ra', str), ('dec', str)), bool,
+     """ Check whether a given RA/Dec pair is visible. 
+     """),
+    ('target_altaz', (('target', str),), (float, float),
+     """ Return a (alt, az) pair containing floats indicating
+     the altitude and azimuth of a target - i.e 'M31', 'NGC4779'
+     """),
+    ('point_altaz', (('ra', str), ('dec', str)), (float, float),
+     None),
+    ('enable_tracking', (), bool,
+     """ Enable the tracking motor for the telescope.
+     """),
+    ('calibrate_motors', (), bool,
+     """ Run the motor calibration routine. 
+     """),
+    ('get_focus', (), float,
+     """ Return the current focus value of the
+     telescope.
+     """),
+    ('set_focus', (('focus', float),), bool,
+     """ Set the focus value of the telescope to
+     {focus}. 
+     """),
+    ('auto_focus', (), bool,
+     """ Automatically focus the telescope
+     using the focus routine. 
+     """),
+    ('current_filter', (), str,
+     """ Return the string name of the current filter. 
+     """),
+    ('change_filter', (('name', str),), bool,
+     """ Change the current filter specified by {filtname}.
+     """),
+    ('make_dir', (('dirname', str),), bool,
+     """ Make a directory on the telescope control server. 
+     """),
+    ('wait', (('wait', int),), None,
+     """ Sleep the telescope for 'wait' seconds. 
+
+     If the time is over telescope.wait_time, shutdown the telescope
+     while we wait, and then reopen before returning. 
+     """),
+    ('wait_until_good', (), bool,
+     """ Wait until the weather is good for observing.
+     """),
+    ('take_exposure', (('filename', str), ('exposure_time', int), ('count', int, 1), ('binning', int, 2)), bool,
+     """ Take a full set of dark frames for a given session. Takes exposure_count
+     dark frames.
+     """),
+    ('take_dark', (('filename', str), ('exposure_time', int), ('count', int, 1), ('binning', int, 2)), bool,
+     """ Take a full set of dark frames for a given session. Takes exposure_count
+     dark frames.
+     """),
+    ('take_bias', (('filename', str), ('count', int, 1), ('binning', int, 2)), bool,
+     """ Take the full set of biases for a given session.
+     This takes exposure_count*numbias biases
+     """),
+)
+
+# source of the method generated for each command
+_TEMPLATE = """
+def {name}(self{signature}):
+    return self._send(prefix, {kwargs})
+"""
+
+# source of each method generated for an asyncio client
+_ASYNC_TEMPLATE = """
+async def {name}(self{signature}):
+    return await self._send(prefix, {kwargs})
+"""
+
+
+def _add_commands(cls: type, template: str = _TEMPLATE) -> type:
+    """ Add a method to {cls} for each command in `_COMMANDS`.
+
+    Each method is compiled from {template} with the exact signature of
+    its command, and sends the serialized prefix of its message directly
+    rather than looking it up through `run_command`.
+    """
+    for name, params, returns, doc in _COMMANDS:
+        signature = ''.join(f', {p[0]}={p[2]!r}' if len(p) > 2 else f', {p[0]}' for p in params)
+        kwargs = '{%s}' % ', '.join(f'{p[0]!r}: {p[0]}' for p in params) if params else 'None'
+
+        # compile the method with the prefix of its message bound as a global
+        namespace = {'prefix': _command_prefix(name)}
+        source = template.format(name=name, signature=signature, kwargs=kwargs)
+        exec(compile(source, f'<{cls.__name__}.{name}>', 'exec'), namespace)
+
+        method = namespace[name]
+        method.__doc__ = doc
+        method.__module__ = cls.__module__
+        method.__qualname__ = f'{cls.__name__}.{name}'
+        method.__annotations__ = {**{p[0]: p[1] for p in params}, 'return': returns}
+        setattr(cls, name, method)
+
+    return cls
+
+
+_add_commands(Telescope)
@@ -0,0 +1,200 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+import unittest
+from unittest import mock
+
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import serve
+
+import telescope.telescope
+from telescope import Telescope
+from telescope.async_telescope import AsyncTelescope
+
+# keep the clients from attaching their own handler, so tests run quietly
+logging.getLogger('telescope').addHandler(logging.NullHandler())
+
+
+class FakeServer(object):
+    """ A TelescopeServer that answers each command in its own thread after
+    sleeping for its `delay` argument, so that replies can arrive in a
+    different order to the commands they answer.
+    """
+
+    def __init__(self):
+        self.received = []
+        self.outstanding = 0
+        self.max_outstanding = 0
+        self.lock = threading.Lock()
+
+        self.server = serve(self.handle, 'localhost', 0)
+        self.port = self.server.socket.getsockname()[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+    @staticmethod
+    def reply(msg: dict) -> dict:
+        time.sleep(msg.get('delay', 0))
+        return {'success': True, 'result': msg['command'], 'id': msg['id']}
+
+    def handle(self, connection):
+        for raw in connection:
+            msg = json.loads(raw)
+            self.received.append(msg)
+
+            if msg.get('action') == 'connect':
+                connection.send(json.dumps({'connected': True}))
+            elif 'batch' in msg:
+                # answer in reverse, so the client has to match replies by id
+                connection.send(json.dumps([self.reply(m) for m in reversed(msg['batch'])]))
+            elif msg['command'] == 'garbage':
+                connection.send('this is not json')
+            else:
+                threading.Thread(target=self.answer, args=(connection, msg), daemon=True).start()
+
+    def answer(self, connection, msg: dict):
+        with self.lock:
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding, self.outstanding)
+
+        reply = self.reply(msg)
+
+        # count the command as answered before the client can send another
+        with self.lock:
+            self.outstanding -= 1
+        try:
+            connection.send(json.dumps(reply))
+        except ConnectionClosed:
+            pass
+
+
+class ServerTestCase(object):
+    """ Run each test against a fresh FakeServer, connecting without
+    prompting for a password.
+    """
+
+    def setUp(self):
+        # cleanups run last first, so clients disconnect before the server closes
+        self.server = FakeServer()
+        self.addCleanup(self.server.close)
+        self.addCleanup(Telescope.shutdown_pool)
+        for patch in (mock.patch('getpass.getpass', return_value='password'),
+                      mock.patch.object(telescope.telescope, '_DEFAULT_PORT', self.server.port)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+
+class TestTelescope(ServerTestCase, unittest.TestCase):
+
+    def connect(self, **kwargs) -> Telescope:
+        t = Telescope('user@example.com', 'localhost', secure=False, **kwargs)
+        self.addCleanup(t.disconnect)
+        return t
+
+    def test_replies_are_routed_by_id(self):
+        t = self.connect()
+        slow = t.run_command_async('slow', delay=0.3)
+
+        # the later command is answered first, without waiting on the slow one
+        self.assertEqual(t.run_command('fast'), 'fast')
+        self.assertFalse(slow.ready())
+        self.assertEqual(slow.get(timeout=2), 'slow')
+
+    def test_batch_is_sent_as_one_message(self):
+        t = self.connect()
+        with t.batch():
+            opened = t.run_command_async('open_dome')
+            pointed = t.run_command_async('goto_target', target='M31')
+
+        self.assertEqual((opened.get(timeout=2), pointed.get(timeout=2)), ('open_dome', 'goto_target'))
+        self.assertEqual([m['command'] for m in self.server.received[-1]['batch']],
+                         ['open_dome', 'goto_target'])
+        self.assertEqual(t.run_commands([{'command': 'a'}, {'command': 'b'}]), ['a', 'b'])
+
+    def test_nowait_is_sent_without_yielding(self):
+        t = self.connect()
+        t.run_command_nowait('close_down')
+
+        # block without yielding to the hub, as a script that then exits would
+        time.sleep(0.3)
+        self.assertEqual(self.server.received[-1]['command'], 'close_down')
+
+    def test_commands_fail_once_reader_dies(self):
+        t = self.connect()
+        pending = t.run_command_async('slow', delay=0.5)
+
+        with self.assertLogs('telescope', logging.WARNING):
+            t.run_command_async('garbage')
+            with self.assertRaises(Exception):
+                pending.get(timeout=2)
+
+        with self.assertRaisesRegex(Exception, 'Not connected'):
+            t.run_command('fast')
+        self.assertFalse(t.is_alive())
+
+    def test_pool_reuses_connection(self):
+        first = self.connect()
+        websocket = first.websocket
+        first.run_command('first')
+        first.disconnect()
+
+        second = self.connect()
+        self.assertIs(second.websocket, websocket)
+        self.assertEqual(second.run_command('second'), 'second')
+
+        # request ids carry on from the connection's previous owner
+        ids = [m['id'] for m in self.server.received if 'id' in m]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_window_limits_commands_in_flight(self):
+        t = self.connect(max_inflight=2)
+        results = [t.run_command_async('slow', delay=0.1) for _ in range(5)]
+
+        self.assertEqual([r.get(timeout=2) for r in results], ['slow'] * 5)
+        self.assertEqual(self.server.max_outstanding, 2)
+
+
+class TestAsyncTelescope(ServerTestCase, unittest.IsolatedAsyncioTestCase):
+
+    async def connect(self) -> AsyncTelescope:
+        t = await AsyncTelescope.create('user@example.com', 'localhost', secure=False)
+        self.addAsyncCleanup(t.disconnect)
+        return t
+
+    async def test_replies_are_routed_by_id(self):
+        t = await self.connect()
+        slow = asyncio.ensure_future(t.run_command('slow', delay=0.3))
+
+        self.assertEqual(await t.run_command('fast'), 'fast')
+        self.assertFalse(slow.done())
+        self.assertEqual(await asyncio.wait_for(slow, 2), 'slow')
+        self.assertEqual(await t.run_commands([{'command': 'a'}, {'command': 'b'}]), ['a', 'b'])
+
+    async def test_commands_fail_once_reader_dies(self):
+        t = await self.connect()
+        pending = asyncio.ensure_future(t.run_command('slow', delay=0.5))
+
+        with self.assertLogs('telescope', logging.WARNING):
+            with self.assertRaises(Exception):
+                await asyncio.wait_for(t.run_command('garbage'), 2)
+            with self.assertRaises(Exception):
+                await asyncio.wait_for(pending, 2)
+
+        with self.assertRaisesRegex(Exception, 'Not connected'):
+            await asyncio.wait_for(t.get_cloud(), 2)
+
+    async def test_commands_fail_after_disconnect(self):
+        t = await self.connect()
+        self.assertTrue(await t.is_alive())
+        await t.disconnect()
+
+        with self.assertRaisesRegex(Exception, 'Not connected'):
+            await t.get_cloud()
+
+
+if __name__ == '__main__':
+    unittest.main()